@@ -10,6 +10,8 @@ import subprocess
 from email.message import EmailMessage
 from pprint import pprint
 
+logger = logging.getLogger('schtaskcheck')
+
 def get_uptime_seconds():
     return ctypes.windll.kernel32.GetTickCount64() / 1000
 
@@ -32,9 +34,7 @@ def main(argv=None):
     cp.read(args.config)
 
     if set(['loggers', 'handlers', 'formatters']).issubset(cp.keys()):
-        logging.config.fileConfig(cp)
-
-    logger = logging.getLogger('schtaskcheck')
+        logging.config.fileConfig(cp, disable_existing_loggers=False)
 
     uptime_seconds = int(cp['schtasks'].get('uptime_seconds', '0'))
     if get_uptime_seconds() <= uptime_seconds:
@@ -0,0 +1,468 @@
+import os
+import pickle
+import smtplib
+import tempfile
+import time
+import unittest
+
+from email import message_from_bytes
+from email import policy
+from unittest import mock
+
+from watcher import NTAIL
+from watcher import SmtpConfig
+from watcher import Watch
+from watcher import WatcherConfigParser
+from watcher import WatcherArchive
+from watcher import WatcherPath
+from watcher import _smtp_from_cp
+from watcher import append_archive
+from watcher import cached_stat
+from watcher import cached_stats
+from watcher import check_and_alert
+from watcher import compile_email
+from watcher import compile_template
+from watcher import human_split
+from watcher import is_prefixed
+from watcher import load_archive
+from watcher import make_email
+from watcher import read_archive
+from watcher import render_sendmail_args
+from watcher import render_template
+from watcher import save_archive
+from watcher import tail_lines
+
+class TestTailLines(unittest.TestCase):
+
+    def setUp(self):
+        self.tempfile = tempfile.NamedTemporaryFile(delete=False, mode='w', encoding='utf-8')
+        for i in range(1, 21):
+            self.tempfile.write(f'Line {i}\n')
+        self.tempfile.close()
+        self.filepath = self.tempfile.name
+
+    def tearDown(self):
+        os.unlink(self.filepath)
+
+    def test_tail_5_lines(self):
+        expected = [f'Line {i}' for i in range(16, 21)]
+        result = tail_lines(self.filepath, n=5)
+        self.assertEqual(result, expected)
+
+    def test_tail_zero_lines(self):
+        expected = []
+        result = tail_lines(self.filepath, n=0)
+        self.assertEqual(result, expected)
+
+
+class TestCachedStat(unittest.TestCase):
+
+    def setUp(self):
+        self.tempfile = tempfile.NamedTemporaryFile(delete=False)
+        self.tempfile.close()
+        self.filepath = self.tempfile.name
+
+    def tearDown(self):
+        os.unlink(self.filepath)
+
+    def test_stat_once(self):
+        stat_cache = {}
+        stat = cached_stat(self.filepath, stat_cache)
+        self.assertIs(cached_stat(self.filepath, stat_cache), stat)
+        self.assertEqual(len(stat_cache), 1)
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            cached_stat(self.filepath + '.missing', {})
+
+    def test_many_paths(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = [os.path.join(tempdir, name) for name in ['a', 'b']]
+            for path in paths:
+                open(path, 'w').close()
+            stat_cache = {}
+            cached_stats(paths + [self.filepath], stat_cache)
+            self.assertEqual(len(stat_cache), 3)
+            with self.assertRaises(FileNotFoundError):
+                cached_stats(paths + [paths[0] + '.missing'], stat_cache)
+
+
+class TestWatcherArchive(unittest.TestCase):
+
+    def test_no_last(self):
+        archive = WatcherArchive({}, 'test_watch_name', '/fake/path/to/archive')
+        self.assertEqual(archive.last_alert_time, 0)
+
+    def test_last_alert_time(self):
+        name = 'test_watch_name'
+        path = '/fake/path/to/archive'
+        key = (name, path)
+        archive = WatcherArchive({key: 1}, name, path)
+        self.assertEqual(archive.last_alert_time, 1)
+
+
+class TestArchiveFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.archive_path = os.path.join(self.tempdir.name, 'archive')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_missing(self):
+        self.assertEqual(load_archive(self.archive_path), {})
+
+    def test_save_and_append(self):
+        save_archive(self.archive_path, {('name', '/path1'): 1.0})
+        append_archive(self.archive_path, 'name', '/path2', 2.0)
+        append_archive(self.archive_path, 'name', '/path1', 3.0)
+        archive = load_archive(self.archive_path)
+        self.assertEqual(archive, {('name', '/path1'): 3.0, ('name', '/path2'): 2.0})
+        save_archive(self.archive_path, archive)
+        self.assertEqual(load_archive(self.archive_path), archive)
+        self.assertEqual(os.listdir(self.tempdir.name), ['archive'])
+
+    def test_save_fsyncs(self):
+        with mock.patch('os.fsync') as fsync:
+            save_archive(self.archive_path, {('name', '/path1'): 1.0})
+        fsync.assert_called_once()
+
+    def test_save_error_removes_temp(self):
+        save_archive(self.archive_path, {('name', '/path1'): 1.0})
+        with mock.patch('os.fsync', side_effect=OSError):
+            with self.assertRaises(OSError):
+                save_archive(self.archive_path, {('name', '/path2'): 2.0})
+        self.assertEqual(os.listdir(self.tempdir.name), ['archive'])
+        self.assertEqual(load_archive(self.archive_path), {('name', '/path1'): 1.0})
+
+    def test_truncated_record(self):
+        append_archive(self.archive_path, 'name', '/path1', 1.0)
+        append_archive(self.archive_path, 'name', '/path2', 2.0)
+        complete_size = os.path.getsize(self.archive_path)
+        append_archive(self.archive_path, 'name', '/path3', 3.0)
+        full_size = os.path.getsize(self.archive_path)
+        # Every truncation point inside the last record.
+        for size in range(complete_size, full_size):
+            with open(self.archive_path, 'r+b') as archive_file:
+                archive_file.truncate(size)
+            archive, needs_compaction = read_archive(self.archive_path)
+            expected = {('name', '/path1'): 1.0, ('name', '/path2'): 2.0}
+            self.assertEqual(archive, expected)
+            self.assertEqual(needs_compaction, size > complete_size)
+            if needs_compaction:
+                save_archive(self.archive_path, archive)
+            # Records appended after repair load.
+            append_archive(self.archive_path, 'name', '/path3', 3.0)
+            expected[('name', '/path3')] = 3.0
+            self.assertEqual(read_archive(self.archive_path), (expected, False))
+
+    def test_truncated_magic(self):
+        with open(self.archive_path, 'wb') as archive_file:
+            archive_file.write(b'WATCH')
+        self.assertEqual(read_archive(self.archive_path), ({}, True))
+
+    def test_compact_pickle(self):
+        archive = {('name', '/path1'): 1.0}
+        with open(self.archive_path, 'wb') as archive_file:
+            pickle.dump(archive, archive_file)
+        self.assertEqual(read_archive(self.archive_path), (archive, True))
+        save_archive(self.archive_path, archive)
+        self.assertEqual(read_archive(self.archive_path), (archive, False))
+
+
+class TestCompileTemplate(unittest.TestCase):
+
+    def assertRendersLikeFormat(self, template, **substitutions):
+        compiled = compile_template(template)
+        expected = template.format(**substitutions)
+        self.assertEqual(render_template(compiled, substitutions), expected)
+
+    def test_literal(self):
+        self.assertRendersLikeFormat('no fields {{here}}')
+
+    def test_fields(self):
+        path = WatcherPath('/fake/path', NTAIL, stat=os.stat_result((0,) * 10), now=90)
+        self.assertRendersLikeFormat(
+            '{path.path} is {path.age_minutes:.1f}m old: {func_expr!r}',
+            path = path,
+            func_expr = 'path.age_hours > 1',
+        )
+
+    def test_index_and_nested_spec(self):
+        self.assertRendersLikeFormat(
+            '{paths[1]:>{width}}',
+            paths = ['a', 'b'],
+            width = 4,
+        )
+
+
+class TestRenderSendmailArgs(unittest.TestCase):
+
+    section = {
+        'subject': 'Alert for {name}',
+        'to': 'to@example.com, Other <other@example.com>',
+        'bcc': 'bcc@example.com',
+        'from': 'from@example.com',
+        'body': 'Alert for {name}\n.dotted line',
+    }
+
+    def assertSameMessage(self, sendmail_args, email_template, substitutions):
+        from_addr, to_addrs, data = sendmail_args
+        self.assertEqual(from_addr, 'from@example.com')
+        self.assertEqual(
+            to_addrs, ['to@example.com', 'other@example.com', 'bcc@example.com'])
+        self.assertNotIn(b'\n', data.replace(b'\r\n', b''))
+        expected = make_email(email_template.headers, substitutions)
+        message = message_from_bytes(data, policy=policy.default)
+        self.assertNotIn('bcc', message)
+        for key in ['subject', 'to', 'from']:
+            self.assertEqual(message[key], expected[key])
+        content = message.get_content().replace('\r\n', '\n')
+        self.assertEqual(content, expected.get_content())
+
+    def test_fields(self):
+        email_template = compile_email(self.section)
+        self.assertIsNone(email_template.prebuilt)
+        substitutions = {'name': 'alert1'}
+        sendmail_args = render_sendmail_args(email_template, substitutions)
+        self.assertSameMessage(sendmail_args, email_template, substitutions)
+
+    def test_prebuilt(self):
+        section = dict(self.section, subject='Alert', body='Alert\n.dotted line')
+        email_template = compile_email(section)
+        self.assertIsNotNone(email_template.prebuilt)
+        sendmail_args = render_sendmail_args(email_template, {})
+        self.assertIs(sendmail_args, email_template.prebuilt)
+        self.assertSameMessage(sendmail_args, email_template, {})
+
+    def test_needs_email_message(self):
+        email_template = compile_email(self.section)
+        for name in ['\u00e9t\u00e9', 'x' * 100]:
+            self.assertIsNone(render_sendmail_args(email_template, {'name': name}))
+
+
+class FakeSMTP:
+    """
+    Record messages sent and session calls instead of connecting.
+    """
+
+    def __init__(self, send_errors):
+        self.send_errors = send_errors
+        self.sent = []
+        self.calls = []
+
+    def sendmail(self, from_addr, to_addrs, data):
+        if self.send_errors:
+            raise self.send_errors.pop(0)
+        self.sent.append(data)
+
+    def send_message(self, email_message):
+        self.sendmail(None, None, email_message.as_bytes())
+
+    def quit(self):
+        self.calls.append('quit')
+
+    def close(self):
+        self.calls.append('close')
+
+
+class FakeSmtpConfig:
+    """
+    Stand in for SmtpConfig, connecting to FakeSMTP sessions that raise the
+    given exceptions from their first sends.
+    """
+
+    def __init__(self, *send_errors):
+        self.send_errors = list(send_errors)
+        self.sessions = []
+
+    def connect(self):
+        smtp = FakeSMTP(self.send_errors)
+        self.sessions.append(smtp)
+        return smtp
+
+
+class CheckAndAlertTestCase(unittest.TestCase):
+    """
+    Files and email template for check_and_alert tests.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for name in ['a', 'b', 'c']:
+            path = os.path.join(self.tempdir.name, name)
+            open(path, 'w').close()
+            self.paths.append(path)
+        self.template = compile_email({
+            'subject': 'Alert for {path.path}',
+            'to': 'to@example.com',
+            'from': 'from@example.com',
+            'body': '{func_expr}',
+        })
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_watch(self, paths, func='max(path.age_seconds, 0) >= 0', min_interval=0):
+        return Watch(
+            name = 'watch',
+            description = '',
+            func_expr = func,
+            func_code = compile(func, '<alert:watch>', 'eval'),
+            paths = tuple(paths),
+            email_key = 'email',
+            template = self.template,
+            min_interval = min_interval,
+        )
+
+
+class TestCheckAndAlert(CheckAndAlertTestCase):
+
+    def test_one_session(self):
+        smtp_config = FakeSmtpConfig()
+        archive = {}
+        check_and_alert(smtp_config, [self.make_watch(self.paths)], archive)
+        self.assertEqual(len(smtp_config.sessions), 1)
+        smtp = smtp_config.sessions[0]
+        self.assertEqual(len(smtp.sent), 3)
+        self.assertEqual(smtp.calls, ['quit', 'close'])
+        self.assertEqual(set(archive), {('watch', path) for path in self.paths})
+
+    def test_no_alert_no_session(self):
+        smtp_config = FakeSmtpConfig()
+        check_and_alert(smtp_config, [self.make_watch(self.paths, func='False')], {})
+        self.assertEqual(smtp_config.sessions, [])
+
+    def test_reconnect_once(self):
+        smtp_config = FakeSmtpConfig(smtplib.SMTPServerDisconnected())
+        check_and_alert(smtp_config, [self.make_watch(self.paths)], {})
+        dropped, smtp = smtp_config.sessions
+        self.assertEqual(dropped.sent, [])
+        self.assertEqual(dropped.calls, ['close'])
+        self.assertEqual(len(smtp.sent), 3)
+        self.assertEqual(smtp.calls, ['quit', 'close'])
+
+    def test_second_disconnect_raises(self):
+        smtp_config = FakeSmtpConfig(
+            smtplib.SMTPServerDisconnected(),
+            smtplib.SMTPServerDisconnected(),
+        )
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            check_and_alert(smtp_config, [self.make_watch(self.paths)], {})
+        self.assertEqual(len(smtp_config.sessions), 2)
+        self.assertEqual(smtp_config.sessions[1].calls, ['quit', 'close'])
+
+    def test_quit_on_error(self):
+        smtp_config = FakeSmtpConfig(smtplib.SMTPRecipientsRefused({}))
+        archive = {}
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            check_and_alert(smtp_config, [self.make_watch(self.paths)], archive)
+        smtp, = smtp_config.sessions
+        self.assertEqual(smtp.calls, ['quit', 'close'])
+        self.assertEqual(archive, {})
+
+
+class TestMinInterval(CheckAndAlertTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Stat of this path would raise if not skipped.
+        self.missing = os.path.join(self.tempdir.name, 'missing')
+        self.watch = self.make_watch([self.missing, self.paths[0]], min_interval=60)
+
+    def test_skip_within_interval(self):
+        smtp_config = FakeSmtpConfig()
+        last_alert_time = time.time() - 30
+        archive = {
+            ('watch', self.missing): last_alert_time,
+            ('watch', self.paths[0]): last_alert_time,
+        }
+        stat_cache = {}
+        check_and_alert(smtp_config, [self.watch], archive, stat_cache=stat_cache)
+        self.assertEqual(stat_cache, {})
+        self.assertEqual(smtp_config.sessions, [])
+        self.assertEqual(archive[('watch', self.paths[0])], last_alert_time)
+
+    def test_check_after_interval(self):
+        smtp_config = FakeSmtpConfig()
+        archive = {
+            ('watch', self.missing): time.time(),
+            ('watch', self.paths[0]): time.time() - 90,
+        }
+        stat_cache = {}
+        check_and_alert(smtp_config, [self.watch], archive, stat_cache=stat_cache)
+        self.assertEqual(list(stat_cache), [os.path.realpath(self.paths[0])])
+        smtp, = smtp_config.sessions
+        self.assertEqual(len(smtp.sent), 1)
+
+    def test_force_names(self):
+        smtp_config = FakeSmtpConfig()
+        watch = self.make_watch(self.paths[:1], func='False', min_interval=60)
+        archive = {('watch', self.paths[0]): time.time()}
+        check_and_alert(smtp_config, [watch], archive, force_names={'watch'})
+        smtp, = smtp_config.sessions
+        self.assertEqual(len(smtp.sent), 1)
+
+
+class TestSmtpConfig(unittest.TestCase):
+
+    def smtp_from_string(self, string):
+        cp = WatcherConfigParser()
+        cp.read_string(string)
+        return _smtp_from_cp(cp)
+
+    def connect_args(self, smtp_config):
+        """
+        Return (host, port) smtplib.SMTP opens a socket to for smtp_config.
+        """
+        get_socket = mock.Mock(side_effect=ConnectionRefusedError)
+        with mock.patch.object(smtplib.SMTP, '_get_socket', get_socket):
+            with self.assertRaises(ConnectionRefusedError):
+                smtp_config.connect()
+        host, port, timeout = get_socket.call_args.args
+        return (host, port)
+
+    def test_coerce(self):
+        smtp_config = self.smtp_from_string('[smtp]\nhost = localhost\nport = 8025')
+        self.assertEqual(smtp_config, SmtpConfig('localhost', 8025))
+        self.assertEqual(self.connect_args(smtp_config), ('localhost', 8025))
+
+    def test_host_port(self):
+        smtp_config = self.smtp_from_string('[smtp]\nhost = mail:587')
+        self.assertEqual(self.connect_args(smtp_config), ('mail', 587))
+
+    def test_no_port(self):
+        smtp_config = self.smtp_from_string('[smtp]\nhost = mail')
+        self.assertEqual(self.connect_args(smtp_config), ('mail', 25))
+
+    def test_local_hostname(self):
+        smtp_config = self.smtp_from_string(
+            '[smtp]\nhost = mail\nlocal_hostname = watcher.example.com')
+        self.assertEqual(smtp_config.local_hostname, 'watcher.example.com')
+        connect = mock.Mock(return_value=(220, b'ready'))
+        with mock.patch.object(smtplib.SMTP, 'connect', connect):
+            smtp = smtp_config.connect()
+        self.assertEqual(smtp.local_hostname, 'watcher.example.com')
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.smtp_from_string('[smtp]\nhost = localhost\nport = smtp')
+        with self.assertRaises(ValueError):
+            self.smtp_from_string('[smtp]\nhost = localhost\nuser = name')
+
+
+class TestMisc(unittest.TestCase):
+
+    def test_human_split(self):
+        self.assertEqual(human_split(''), [])
+        self.assertEqual(human_split('alert_name'), ['alert_name'])
+        self.assertEqual(human_split('alert1 alert2'), ['alert1', 'alert2'])
+        self.assertEqual(human_split('alert1, alert2'), ['alert1', 'alert2'])
+
+    def test_is_prefixed(self):
+        self.assertTrue(is_prefixed('path', 'path'))
+        self.assertTrue(is_prefixed('path1', 'path'))
+        self.assertFalse(is_prefixed('func1', 'path'))
+        self.assertFalse(is_prefixed('pathx', 'path'))
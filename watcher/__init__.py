@@ -1,19 +1,23 @@
 import argparse
-import logging.config
+import logging
+import mmap
+import operator
 import os
-import pickle
-import smtplib
-import tempfile
+import re
+import string
+import struct
 import time
-import unittest
 
 from abc import ABC
 from abc import abstractmethod
 from collections import namedtuple
 from configparser import ConfigParser
 from configparser import ExtendedInterpolation
+from dataclasses import dataclass
 from email.message import EmailMessage
+from email.utils import getaddresses
 from functools import cached_property
+from functools import lru_cache
 
 instance_config_path = 'instance/watcher.ini'
 
@@ -21,60 +25,40 @@ keys_for_set_contents = set([
     'body',
 ])
 
+# Longest header or body line EmailMessage leaves unfolded and unencoded.
+MAX_LINE_LENGTH = EmailMessage().policy.max_line_length
+
+# Headers EmailMessage.set_content adds for short ascii text.
+TEXT_CONTENT_HEADERS = (
+    'Content-Type: text/plain; charset="utf-8"',
+    'Content-Transfer-Encoding: 7bit',
+    'MIME-Version: 1.0',
+)
+
 logger = logging.getLogger('watcher')
 
 # number of lines for tail
 NTAIL = 10
 
-class TestTailLines(unittest.TestCase):
-
-    def setUp(self):
-        self.tempfile = tempfile.NamedTemporaryFile(delete=False, mode='w', encoding='utf-8')
-        for i in range(1, 21):
-            self.tempfile.write(f'Line {i}\n')
-        self.tempfile.close()
-        self.filepath = self.tempfile.name
-
-    def tearDown(self):
-        os.unlink(self.filepath)
-
-    def test_tail_5_lines(self):
-        expected = [f'Line {i}' for i in range(16, 21)]
-        result = tail_lines(self.filepath, n=5)
-        self.assertEqual(result, expected)
-
-    def test_tail_zero_lines(self):
-        expected = []
-        result = tail_lines(self.filepath, n=0)
-        self.assertEqual(result, expected)
+# Archive file is this magic followed by records of this header, then the
+# utf-8 encoded watch name and path. Later records override earlier ones.
+ARCHIVE_MAGIC = b'WATCHER\x01'
+ARCHIVE_HDR = struct.Struct('<dHH')
 
+_formatter = string.Formatter()
 
-class TestWatcherArchive(unittest.TestCase):
+# Separators for lists in config values.
+_SPLIT_RE = re.compile(r'[,\s]+').split
 
-    def test_no_last(self):
-        archive = WatcherArchive({}, 'test_watch_name', '/fake/path/to/archive')
-        self.assertEqual(archive.last_alert_time, 0)
+# Alert section keys for paths: "path", "path1", "path2", etc.
+_PATH_KEY_RE = re.compile(r'path\d*\Z').match
 
-    def test_last_alert_time(self):
-        name = 'test_watch_name'
-        path = '/fake/path/to/archive'
-        key = (name, path)
-        archive = WatcherArchive({key: 1}, name, path)
-        self.assertEqual(archive.last_alert_time, 1)
-
-
-class TestMisc(unittest.TestCase):
-
-    def test_human_split(self):
-        self.assertEqual(human_split(''), [])
-        self.assertEqual(human_split('alert_name'), ['alert_name'])
-        self.assertEqual(human_split('alert1 alert2'), ['alert1', 'alert2'])
-        self.assertEqual(human_split('alert1, alert2'), ['alert1', 'alert2'])
-
-    def test_is_prefixed(self):
-        self.assertTrue(is_prefixed('path', 'path'))
-        self.assertTrue(is_prefixed('path1', 'path'))
+# Symlinks resolved once per path for the stat cache keys.
+_realpath = lru_cache(maxsize=None)(os.path.realpath)
 
+# Globals for evaluating alert funcs, reused for every path. Builtins are
+# available to the funcs as with eval(expr, {}, context).
+_EVAL_GLOBALS = {}
 
 class WatcherConfigParser(ConfigParser):
     """
@@ -92,26 +76,39 @@ class WatcherPath:
     Wrap a path in a useful object for the alert functions to use.
     """
 
-    def __init__(self, path, ntail):
+    def __init__(self, path, ntail, stat=None, now=None):
         self.path = path
         self.ntail = ntail
-        self.stat = os.stat(self.path)
+        if stat is None:
+            stat = os.stat(self.path)
+        self.stat = stat
+        self.mtime = stat.st_mtime
+        if now is None:
+            now = time.time()
+        self.now = now
+
+    @classmethod
+    def get(cls, path, ntail, stat_cache, now=None):
+        """
+        Instance for path with stat result from, or saved into, stat_cache.
+        """
+        return cls(path, ntail, stat=cached_stat(path, stat_cache), now=now)
 
-    @cached_property
+    @property
     def age_seconds(self):
-        return time.time() - self.stat.st_mtime
+        return self.now - self.mtime
 
-    @cached_property
+    @property
     def age_minutes(self):
-        return self.age_seconds / 60
+        return (self.now - self.mtime) / 60
 
-    @cached_property
+    @property
     def age_hours(self):
-        return self.age_minutes / 60
+        return (self.now - self.mtime) / 3600
 
-    @cached_property
+    @property
     def age_days(self):
-        return self.age_hours / 24
+        return (self.now - self.mtime) / 86400
 
     @cached_property
     def human_age(self):
@@ -124,38 +121,102 @@ class WatcherPath:
         return '\n'.join(tail_lines(self.path))
 
 
-WatcherArchiveBase = namedtuple(
-    'WatcherArchiveBase',
-    ['archive_data', 'watch_name', 'path'],
+@dataclass(frozen=True, slots=True)
+class SmtpConfig:
+    """
+    SMTP server from the smtp config section.
+    """
+
+    host: str
+    # Zero lets smtplib take the port from "host:port", or else use 25.
+    port: int = 0
+    local_hostname: str | None = None
+    timeout: float = 30.0
+
+    def connect(self):
+        import smtplib
+        return smtplib.SMTP(
+            self.host,
+            self.port,
+            local_hostname = self.local_hostname,
+            timeout = self.timeout,
+        )
+
+
+EmailTemplate = namedtuple(
+    'EmailTemplate',
+    ['headers', 'prebuilt'],
+)
+
+Watch = namedtuple(
+    'Watch',
+    [
+        'name',
+        'description',
+        'func_expr',
+        'func_code',
+        'paths',
+        'email_key',
+        'template',
+        'min_interval',
+    ],
 )
 
-class WatcherArchive(WatcherArchiveBase):
+class WatcherArchive:
+    """
+    Last alert time of a watch and path for the alert functions to use.
+    """
+
+    __slots__ = ('archive_data', 'watch_name', 'path', 'now', '_last')
+
+    def __init__(self, archive_data, watch_name, path, now=None):
+        self.archive_data = archive_data
+        self.watch_name = watch_name
+        self.path = path
+        if now is None:
+            now = time.time()
+        self.now = now
+        self._last = archive_data.get((watch_name, path), 0)
 
     @property
     def last_alert_time(self):
-        key = (self.watch_name, self.path)
-        if key in self.archive_data:
-            return self.archive_data[key]
-        else:
-            return 0
+        return self._last
 
-    @cached_property
+    @property
     def last_alert_age_seconds(self):
-        return time.time() - self.last_alert_time
+        return self.now - self._last
 
-    @cached_property
+    @property
     def last_alert_age_minutes(self):
         return self.last_alert_age_seconds / 60
 
-    @cached_property
+    @property
     def last_alert_age_hours(self):
-        return self.last_alert_age_minutes / 60
+        return self.last_alert_age_seconds / 3600
 
-    @cached_property
+    @property
     def last_alert_age_days(self):
-        return self.last_alert_age_hours / 24
+        return self.last_alert_age_seconds / 86400
 
 
+def cached_stat(path, stat_cache):
+    """
+    Return os.stat result for path, calling os.stat at most once per real path
+    in stat_cache.
+    """
+    key = _realpath(path)
+    if key not in stat_cache:
+        stat_cache[key] = os.stat(key)
+    return stat_cache[key]
+
+def cached_stats(paths, stat_cache):
+    """
+    Fill stat_cache for all paths, raising FileNotFoundError for the first
+    missing path.
+    """
+    for path in paths:
+        cached_stat(path, stat_cache)
+
 def tail_lines(filepath, n=10, block_size=1024):
     """
     Return the last n lines of a file.
@@ -194,87 +255,194 @@ def config_filenames_from_args(args):
     return config_filenames
 
 def human_split(string):
-    return string.replace(',', ' ').split()
+    return [item for item in _SPLIT_RE(string) if item]
 
 def is_prefixed(key, prefix):
-    n = len(prefix)
-    return key.startswith(prefix) and key[n:] == '' or key[n:].isdigit()
+    return (
+        key.startswith(prefix)
+        and (len(key) == len(prefix) or key[len(prefix):].isdigit())
+    )
+
+def _smtp_from_cp(cp):
+    """
+    Return SmtpConfig from the smtp section, raising for unknown keys and
+    values of the wrong type.
+    """
+    section = _freeze_section(cp['smtp'])
+    converters = {
+        'host': str,
+        'port': int,
+        'local_hostname': str,
+        'timeout': float,
+    }
+    unknown = set(section).difference(converters)
+    if unknown:
+        raise ValueError(f'Unknown smtp keys {sorted(unknown)}.')
+    return SmtpConfig(**{key: converters[key](value) for key, value in section.items()})
+
+def _freeze_section(section):
+    """
+    Return plain dict of config section, interpolating every value once.
+    """
+    return {key: section[key] for key in section}
+
+def field_getter(field_name):
+    """
+    Return function getting the value for a format string field name from a
+    dict of substitutions.
+    """
+    root, dot, attrs = field_name.partition('.')
+    if '[' in field_name or not root.isidentifier():
+        # Uncommon field names are left to string.Formatter.
+        def getter(substitutions):
+            return _formatter.get_field(field_name, (), substitutions)[0]
+    elif dot:
+        get_attrs = operator.attrgetter(attrs)
+        def getter(substitutions):
+            return get_attrs(substitutions[root])
+    else:
+        getter = operator.itemgetter(root)
+    return getter
+
+def compile_template(template):
+    """
+    Parse format string once into a list of (literal, getter, format_spec,
+    conversion) tuples for render_template.
+    """
+    compiled = []
+    for literal, field_name, format_spec, conversion in _formatter.parse(template):
+        if field_name is None:
+            getter = None
+        else:
+            getter = field_getter(field_name)
+        compiled.append((literal, getter, format_spec, conversion))
+    return compiled
+
+def render_template(compiled, substitutions):
+    """
+    Format a template from compile_template, like str.format(**substitutions).
+    """
+    parts = []
+    for literal, getter, format_spec, conversion in compiled:
+        parts.append(literal)
+        if getter is None:
+            continue
+        value = getter(substitutions)
+        if conversion:
+            value = _formatter.convert_field(value, conversion)
+        if '{' in format_spec:
+            # Nested fields in the format spec.
+            format_spec = _formatter.vformat(format_spec, (), substitutions)
+        parts.append(format(value, format_spec))
+    return ''.join(parts)
+
+def compile_email(section):
+    """
+    Return EmailTemplate of format strings compiled by header key. Templates
+    without any fields are also rendered once into their sendmail arguments.
+    """
+    headers = {key: compile_template(template) for key, template in section.items()}
+    has_fields = any(
+        getter is not None
+        for template in headers.values()
+        for literal, getter, format_spec, conversion in template
+    )
+    if has_fields:
+        prebuilt = None
+    else:
+        prebuilt = message_sendmail_args(make_email(headers, {}))
+    return EmailTemplate(headers=headers, prebuilt=prebuilt)
 
 def emails_from_config(cp):
     """
     Return dict of keyed email templates.
     """
     keys = human_split(cp['email']['keys'])
-    emails = {key: cp['email.' + key] for key in keys}
+    emails = {key: compile_email(_freeze_section(cp['email.' + key])) for key in keys}
     return emails
 
-def watches_from_config(cp):
+def watches_from_config(cp, emails):
     """
-    Return dict of named watches.
+    Return tuple of watches, resolving their email templates from emails.
     """
-    watches = {}
+    watches = []
+    watch_names = set()
     for watch_name in human_split(cp['watcher']['alerts']):
         # Raise for duplicate keys in string list.
-        if watch_name in watches:
+        if watch_name in watch_names:
             raise KeyError(f'Duplicate key {watch_name}')
-        section = cp['alert.' + watch_name]
+        watch_names.add(watch_name)
+        section = _freeze_section(cp['alert.' + watch_name])
         # Description
-        description = section.get('description', fallback='')
+        description = section.get('description', '')
         # Normalize paths from section.
         paths = []
         for key, value in section.items():
             # Allow "path", "path1", "path2", etc.
-            if is_prefixed(key, 'path'):
+            if _PATH_KEY_RE(key):
                 paths.append(os.path.normpath(value))
         # Create and append a watch.
         func_expr = section['func']
+        func_code = compile(func_expr, f'<alert:{watch_name}>', 'eval')
         email_key = section['email']
-        watch_data = {
-            'name': watch_name,
-            'description': description,
-            'func_expr': func_expr,
-            'paths': paths,
-            'email_key': email_key,
-        }
-        watches[watch_name] = watch_data
-    return watches
-
-def raise_for_sanity(emails, watches):
+        # Optional seconds to wait after an alert before checking the path
+        # again.
+        min_interval = float(section.get('min_interval_seconds', 0))
+        watch = Watch(
+            name = watch_name,
+            description = description,
+            func_expr = func_expr,
+            func_code = func_code,
+            paths = tuple(paths),
+            email_key = email_key,
+            # Missing email keys are raised by raise_for_sanity.
+            template = emails.get(email_key),
+            min_interval = min_interval,
+        )
+        watches.append(watch)
+    return tuple(watches)
+
+def raise_for_sanity(emails, watches, stat_cache=None):
     """
     Check the sanity of objects created from config.
     """
+    if stat_cache is None:
+        stat_cache = {}
     # Raise for missing email keys.
-    for watch in watches.values():
-        email_key = watch['email_key']
+    for watch in watches:
+        email_key = watch.email_key
         if email_key not in emails:
             raise KeyError(f'Invalid email key {email_key}.')
 
-    for watch in watches.values():
-        # Raise for empty paths.
-        if not watch['paths']:
+    # Raise for empty paths.
+    for watch in watches:
+        if not watch.paths:
             raise ValueError('Empty paths.')
-        # Raise for any path not found.
-        for path in watch['paths']:
-            if not os.path.exists(path):
-                raise FileNotFoundError(path)
 
-def update_last_alert(watch_name, path, archive_watcher):
+    # Raise for any path not found.
+    # Stat results are kept for check_and_alert.
+    cached_stats((path for watch in watches for path in watch.paths), stat_cache)
+
+def update_last_alert(watch_name, path, archive_watcher, archive_path=None):
     """
     Save the last alerted time by the alert's name from config and the path it
-    alerted for.
+    alerted for, appending it to the archive file if given.
     """
-    archive_watcher.archive_data[(watch_name, path)] = time.time()
+    alert_time = time.time()
+    archive_watcher.archive_data[(watch_name, path)] = alert_time
+    if archive_path is not None:
+        append_archive(archive_path, watch_name, path, alert_time)
 
 def make_email(email_template, substitutions):
     """
     :param email_template:
-        Dict of email header keys and format string values.
+        Dict of email header keys and compiled format string values.
     """
     email_message = EmailMessage()
     # The ini config section keys are direct attributes of email objects.
     for key, template in email_template.items():
         # Format string.
-        string = template.format(**substitutions)
+        string = render_template(template, substitutions)
         # Update email message.
         if key.lower() in keys_for_set_contents:
             email_message.set_content(string)
@@ -282,67 +450,297 @@ def make_email(email_template, substitutions):
             email_message[key] = string
     return email_message
 
-def check_and_alert(smtp_config, emails, watches, archive_data, force_names=None):
+def envelope_addresses(headers):
+    """
+    Return (from_addr, to_addrs) from dict of lowercase header keys, as
+    smtplib.send_message takes them. None for missing sender or addresses
+    needing SMTPUTF8.
+    """
+    sender = headers.get('sender', headers.get('from'))
+    if sender is None:
+        return None
+    from_addr = getaddresses([sender])[0][1]
+    fields = [headers[key] for key in ('to', 'bcc', 'cc') if key in headers]
+    to_addrs = [address for name, address in getaddresses(fields)]
+    if not ''.join([from_addr, *to_addrs]).isascii():
+        return None
+    return (from_addr, to_addrs)
+
+def message_sendmail_args(email_message):
+    """
+    Return (from_addr, to_addrs, data) to send email message with
+    smtp.sendmail or None if it needs smtp.send_message.
+    """
+    if any(key.lower().startswith('resent-') for key in email_message.keys()):
+        return None
+    headers = {key.lower(): str(value) for key, value in email_message.items()}
+    envelope = envelope_addresses(headers)
+    if envelope is None:
+        return None
+    del email_message['bcc']
+    data = email_message.as_bytes(policy=email_message.policy.clone(linesep='\r\n'))
+    return (*envelope, data)
+
+def render_sendmail_args(email_template, substitutions):
+    """
+    Return (from_addr, to_addrs, data) rendering email template directly to
+    bytes, or None when a value needs the folding or encoding of EmailMessage.
+    """
+    if email_template.prebuilt is not None:
+        return email_template.prebuilt
+
+    headers = {}
+    lines = []
+    body = None
+    for key, template in email_template.headers.items():
+        value = render_template(template, substitutions)
+        lower_key = key.lower()
+        if lower_key in keys_for_set_contents:
+            body = value
+            continue
+        line = f'{key}: {value}'
+        if (
+            not line.isascii()
+            or len(line) > MAX_LINE_LENGTH
+            or '\r' in value
+            or '\n' in value
+            or lower_key.startswith('resent-')
+        ):
+            return None
+        headers[lower_key] = value
+        # Bcc is only for the envelope.
+        if lower_key != 'bcc':
+            lines.append(line.encode('ascii'))
+
+    if body is None or not body.isascii():
+        return None
+    body_lines = body.encode('ascii').splitlines()
+    if any(len(line) > MAX_LINE_LENGTH for line in body_lines):
+        return None
+
+    envelope = envelope_addresses(headers)
+    if envelope is None:
+        return None
+
+    lines.extend(header.encode('ascii') for header in TEXT_CONTENT_HEADERS)
+    lines.append(b'')
+    lines.extend(body_lines)
+    return (*envelope, b'\r\n'.join(lines) + b'\r\n')
+
+def send_email(smtp, email_template, substitutions):
+    """
+    Send email from template, skipping EmailMessage when possible.
+    """
+    sendmail_args = render_sendmail_args(email_template, substitutions)
+    if sendmail_args is None:
+        email_message = make_email(email_template.headers, substitutions)
+        smtp.send_message(email_message)
+    else:
+        smtp.sendmail(*sendmail_args)
+
+def probe_smtp(smtp_config):
+    """
+    Connect to and quit the configured SMTP server, raising for failure.
+    """
+    with smtp_config.connect():
+        pass
+
+def check_and_alert(
+    smtp_config,
+    watches,
+    archive_data,
+    force_names = None,
+    stat_cache = None,
+    archive_path = None,
+):
     """
     Test each watch path against the alert expression and send emails.
     """
     if force_names is None:
         force_names = set()
-    for watch_name, watch in watches.items():
-        # Test each path for alert.
-        for path in watch['paths']:
-            # Wrap path and archive for convenient attributes
-            watcher_path = WatcherPath(path, NTAIL)
-            watcher_archive = WatcherArchive(archive_data, watch_name, path)
-            context = {
-                'path': watcher_path,
-                'archive': watcher_archive,
-            }
-            try:
-                logger.info('checking %s', path)
-                need_alert = eval(watch['func_expr'], {}, context)
-                if watch_name in force_names:
-                    need_alert = True
-            except Exception:
-                # Log exception and continue to next path.
-                logger.exception(
-                    'Exception evaluating alert func for %r.', watch_name)
-                continue
-            if need_alert:
-                # Construct email from format strings.
-                email_template = emails[watch['email_key']]
-                substitutions = dict(
-                    path = watcher_path,
-                    func_expr = watch['func_expr'],
-                    description = watch['description'],
-                )
-                substitutions.update(watch)
-                email_message = make_email(email_template, substitutions)
-                # Send email alert.
-                with smtplib.SMTP(**smtp_config) as smtp:
-                    smtp.send_message(email_message)
-                # Update archive last alert time.
-                update_last_alert(watch_name, path, watcher_archive)
-                logger.info('alerted for %r', watch_name)
+    if stat_cache is None:
+        stat_cache = {}
+    # One SMTP session is shared by all the alerts.
+    smtp = None
+    try:
+        for watch in watches:
+            watch_name = watch.name
+            # Test each path for alert.
+            for path in watch.paths:
+                now = time.time()
+                # Skip paths alerted within the minimum interval before
+                # touching the filesystem.
+                if watch_name not in force_names:
+                    last_alert_time = archive_data.get((watch_name, path), 0)
+                    if now - last_alert_time < watch.min_interval:
+                        logger.info('skipping %s, alerted recently', path)
+                        continue
+                # Wrap path and archive for convenient attributes, sharing one
+                # timestamp for all the age attributes.
+                watcher_path = WatcherPath.get(path, NTAIL, stat_cache, now=now)
+                watcher_archive = WatcherArchive(archive_data, watch_name, path, now)
+                context = {
+                    'path': watcher_path,
+                    'archive': watcher_archive,
+                }
+                try:
+                    logger.info('checking %s', path)
+                    need_alert = eval(watch.func_code, _EVAL_GLOBALS, context)
+                    if watch_name in force_names:
+                        need_alert = True
+                except Exception:
+                    # Log exception and continue to next path.
+                    logger.exception(
+                        'Exception evaluating alert func for %r.', watch_name)
+                    continue
+                if need_alert:
+                    # Construct email from format strings.
+                    substitutions = watch._asdict()
+                    substitutions['path'] = watcher_path
+                    # Send email alert, connecting on the first one. Imported
+                    # here for the common run without alerts.
+                    import smtplib
+                    if smtp is None:
+                        smtp = smtp_config.connect()
+                    try:
+                        send_email(smtp, watch.template, substitutions)
+                    except smtplib.SMTPServerDisconnected:
+                        # Reconnect once for a session dropped by the server.
+                        smtp.close()
+                        smtp = None
+                        smtp = smtp_config.connect()
+                        send_email(smtp, watch.template, substitutions)
+                    # Update archive last alert time.
+                    update_last_alert(watch_name, path, watcher_archive, archive_path)
+                    logger.info('alerted for %r', watch_name)
+    finally:
+        if smtp is not None:
+            quit_smtp(smtp)
+
+def quit_smtp(smtp):
+    """
+    End SMTP session, closing the connection even if QUIT fails.
+    """
+    import smtplib
+    try:
+        smtp.quit()
+    except smtplib.SMTPServerDisconnected:
+        pass
+    finally:
+        smtp.close()
+
+def pack_archive_record(watch_name, path, alert_time):
+    name_bytes = watch_name.encode('utf-8')
+    path_bytes = path.encode('utf-8')
+    header = ARCHIVE_HDR.pack(alert_time, len(name_bytes), len(path_bytes))
+    return header + name_bytes + path_bytes
+
+def unpack_archive(buffer):
+    """
+    Return archive dict from the records in buffer and the offset where the
+    last complete record ends. A truncated trailing record from an
+    interrupted append is ignored.
+    """
+    archive = {}
+    offset = len(ARCHIVE_MAGIC)
+    end = len(buffer)
+    while offset + ARCHIVE_HDR.size <= end:
+        alert_time, name_len, path_len = ARCHIVE_HDR.unpack_from(buffer, offset)
+        record_end = offset + ARCHIVE_HDR.size + name_len + path_len
+        if record_end > end:
+            break
+        offset += ARCHIVE_HDR.size
+        watch_name = buffer[offset:offset + name_len].decode('utf-8')
+        offset += name_len
+        path = buffer[offset:offset + path_len].decode('utf-8')
+        offset += path_len
+        archive[(watch_name, path)] = alert_time
+    return archive, offset
+
+def is_binary_archive(archive_file):
+    magic = archive_file.read(len(ARCHIVE_MAGIC))
+    archive_file.seek(0)
+    return magic == ARCHIVE_MAGIC
+
+def compact_archive_size(archive):
+    """
+    Size in bytes of archive written with one record per key.
+    """
+    size = len(ARCHIVE_MAGIC)
+    for watch_name, path in archive:
+        size += ARCHIVE_HDR.size
+        size += len(watch_name.encode('utf-8')) + len(path.encode('utf-8'))
+    return size
+
+def read_archive(archive_path):
+    """
+    Return archive dict from file, accepting the older pickle format, and
+    whether the file needs rewriting before records are appended to it.
+
+    The file needs rewriting when it is in the older pickle format, ends with
+    a truncated record, or has grown past twice its compact size from
+    appended records.
+    """
+    if not (os.path.exists(archive_path) and os.path.getsize(archive_path) > 0):
+        return {}, False
+    with open(archive_path, 'rb') as archive_file:
+        magic = archive_file.read(len(ARCHIVE_MAGIC))
+        if len(magic) < len(ARCHIVE_MAGIC) and ARCHIVE_MAGIC.startswith(magic):
+            # Magic itself truncated by the first interrupted append.
+            return {}, True
+        archive_file.seek(0)
+        if not is_binary_archive(archive_file):
+            import pickle
+            return pickle.load(archive_file), True
+        with mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            archive, end = unpack_archive(buffer)
+            size = len(buffer)
+    needs_compaction = end < size or size > 2 * compact_archive_size(archive)
+    return archive, needs_compaction
 
 def load_archive(archive_path):
-    if os.path.exists(archive_path) and os.path.getsize(archive_path) > 0:
-        with open(archive_path, 'rb') as archive_file:
-            archive = pickle.load(archive_file)
-    else:
-        archive = {}
+    """
+    Load archive dict from file, accepting the older pickle format.
+    """
+    archive, needs_compaction = read_archive(archive_path)
     return archive
 
+def append_archive(archive_path, watch_name, path, alert_time):
+    """
+    Append one record to the archive file, creating it if necessary.
+    """
+    with open(archive_path, 'ab') as archive_file:
+        if archive_file.tell() == 0:
+            archive_file.write(ARCHIVE_MAGIC)
+        archive_file.write(pack_archive_record(watch_name, path, alert_time))
+
 def save_archive(archive_path, archive):
-    with open(archive_path, 'wb') as archive_file:
-        pickle.dump(archive, archive_file)
+    """
+    Write whole archive with one record per key, replacing the file only
+    after it is completely written and flushed to disk.
+    """
+    temp_path = archive_path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as archive_file:
+            archive_file.write(ARCHIVE_MAGIC)
+            for (watch_name, path), alert_time in archive.items():
+                archive_file.write(pack_archive_record(watch_name, path, alert_time))
+            # Data must be on disk before the rename can be.
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+        os.replace(temp_path, archive_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 def has_logging(cp):
     return set(['loggers', 'handlers', 'formatters']).issubset(cp)
 
 def ensure_logging(cp):
     if has_logging(cp):
-        logging.config.fileConfig(cp)
+        from logging.config import fileConfig
+        fileConfig(cp, disable_existing_loggers=False)
     else:
         logging.basicConfig()
 
@@ -357,26 +755,42 @@ def run_from_args(args):
     ensure_logging(cp)
 
     # SMTP configuration.
-    smtp_config = dict(cp['smtp'])
+    smtp_config = _smtp_from_cp(cp)
 
     # Email templates from configuration.
     emails = emails_from_config(cp)
 
     # Get list of all referenced watcher sections, raising for key errors.
-    watches = watches_from_config(cp)
+    watches = watches_from_config(cp, emails)
+
+    # Stat each unique path once for the whole run.
+    stat_cache = {}
 
     # Raise early for sanity.
-    raise_for_sanity(emails, watches)
+    raise_for_sanity(emails, watches, stat_cache)
 
     # Load archive
     archive_path = cp['watcher']['archive']
-    archive = load_archive(archive_path)
+    archive, needs_compaction = read_archive(archive_path)
 
-    # Check and alert for all watches. Archive is updated here.
-    check_and_alert(smtp_config, emails, watches, archive, force_names=set(args.test or []))
+    # Rewrite archive converting older format, dropping overridden records and
+    # any truncated record before alerts are appended to it.
+    if needs_compaction:
+        save_archive(archive_path, archive)
 
-    # Save archive
-    save_archive(archive_path, archive)
+    # Only connect before alerting when asked, most runs send nothing.
+    if args.test_smtp:
+        probe_smtp(smtp_config)
+
+    # Check and alert for all watches. Archive is updated here.
+    check_and_alert(
+        smtp_config,
+        watches,
+        archive,
+        force_names = set(args.test or []),
+        stat_cache = stat_cache,
+        archive_path = archive_path,
+    )
 
 def argument_parser():
     parser = argparse.ArgumentParser(
@@ -397,6 +811,11 @@ def argument_parser():
         nargs = '+',
         help = f'Force emails from given keys.',
     )
+    parser.add_argument(
+        '--test-smtp',
+        action = 'store_true',
+        help = 'Connect to SMTP server before checking alerts.',
+    )
     return parser
 
 def main(argv=None):